@@ -1,4 +1,8 @@
 import { spawn } from 'child_process';
+import { createHmac, randomBytes } from 'crypto';
+import fs from 'fs';
+import * as net from 'net';
+import os from 'os';
 import path from 'path';
 import { BaseIntegration, ConnectionTestResult, MetricInfo, ApiCapability } from './base';
 import {
@@ -21,74 +25,289 @@ interface PythonResult {
   device?: KasaDevice | KasaDeviceInfo;
   energy?: KasaEnergyUsage;
   count?: number;
+  errors?: string[];
 }
 
-export class KasaIntegration extends BaseIntegration {
-  readonly type = 'kasa';
-  readonly name = 'TP-Link Kasa';
+// Client for a `kasa_helper.py serve` Unix socket server. Requests and replies
+// are length-prefixed JSON matched by id. The server outlives any one caller, so
+// every backend worker using the same credentials shares one warm Python process
+// and its device cache.
+class KasaHelperClient {
+  private socket: net.Socket | null = null;
+  private connecting: Promise<net.Socket> | null = null;
+  private buffer = Buffer.alloc(0);
+  private nextId = 1;
+  // Pending requests, with the devices streamed so far by multi-frame replies
+  private pending = new Map<number, { resolve: (result: PythonResult) => void; devices: KasaDevice[] }>();
 
-  // Parse deviceIps from comma-separated string or array
-  private parseDeviceIps(config: KasaConfig): string[] {
-    const deviceIps = config.deviceIps;
-    if (!deviceIps) return [];
-    if (Array.isArray(deviceIps)) return deviceIps.filter((ip: string) => ip.trim());
-    if (typeof deviceIps === 'string') {
-      return deviceIps.split(',').map((ip: string) => ip.trim()).filter((ip: string) => ip);
+  constructor(
+    private readonly socketPath: string,
+    private readonly env: NodeJS.ProcessEnv
+  ) {}
+
+  async run(args: string[]): Promise<PythonResult> {
+    let socket: net.Socket;
+    try {
+      socket = await this.connect();
+    } catch (err) {
+      const message = err instanceof Error ? err.message : String(err);
+      return { error: `Failed to run Python: ${message}` };
     }
-    return [];
-  }
 
-  // Execute the Python helper script
-  private async runPythonHelper(args: string[], config?: KasaConfig): Promise<PythonResult> {
     return new Promise((resolve) => {
-      // Pass credentials via environment variables
-      const env = { ...process.env };
-      if (config?.email) {
-        env.KASA_EMAIL = config.email;
-      }
-      if (config?.password) {
-        env.KASA_PASSWORD = config.password;
+      if (socket.destroyed) {
+        resolve({ error: 'Python helper connection closed' });
+        return;
       }
+      const id = this.nextId++;
+      this.pending.set(id, { resolve, devices: [] });
+      const body = Buffer.from(JSON.stringify({ id, command: args[0], args: args.slice(1) }));
+      const header = Buffer.alloc(4);
+      header.writeUInt32BE(body.length);
+      socket.write(Buffer.concat([header, body]));
+    });
+  }
 
-      const python = spawn('python3', [KASA_HELPER_PATH, ...args], { env });
-      let stdout = '';
-      let stderr = '';
+  // Connect to a running server, starting one if none is listening
+  private connect(): Promise<net.Socket> {
+    if (this.socket) return Promise.resolve(this.socket);
+    if (!this.connecting) {
+      this.connecting = this.openSocket()
+        .catch(() => this.startServer().then(() => this.openSocket()))
+        .then((socket) => {
+          this.attach(socket);
+          return socket;
+        })
+        .finally(() => {
+          this.connecting = null;
+        });
+    }
+    return this.connecting;
+  }
 
-      python.stdout.on('data', (data) => {
-        stdout += data.toString();
+  private openSocket(): Promise<net.Socket> {
+    return new Promise((resolve, reject) => {
+      const socket = net.createConnection({ path: this.socketPath });
+      socket.once('error', reject);
+      socket.once('connect', () => {
+        socket.off('error', reject);
+        resolve(socket);
       });
+    });
+  }
 
-      python.stderr.on('data', (data) => {
-        stderr += data.toString();
+  // Spawn the server and wait until it reports that the socket is bound
+  private startServer(): Promise<void> {
+    return new Promise((resolve, reject) => {
+      // Detached so the server keeps running for other workers after this process exits
+      const python = spawn('python3', [KASA_HELPER_PATH, 'serve', this.socketPath], {
+        env: this.env,
+        stdio: ['ignore', 'pipe', 'pipe'],
+        detached: true,
       });
+      let stdout = '';
 
-      python.on('close', (code) => {
-        if (stderr) {
-          logger.debug('kasa', 'Python stderr', { stderr });
-        }
-
-        if (code !== 0) {
-          logger.error('kasa', 'Python helper failed', { code, stderr });
-          resolve({ error: stderr || `Process exited with code ${code}` });
-          return;
-        }
+      // After the ready line the server writes nothing more, so let it go
+      const release = () => {
+        python.stdout.destroy();
+        python.stderr.destroy();
+        python.unref();
+      };
 
+      python.stdout.on('data', (data) => {
+        stdout += data.toString();
+        const newline = stdout.indexOf('\n');
+        if (newline === -1) return;
         try {
-          const result = JSON.parse(stdout);
-          resolve(result);
+          const result = JSON.parse(stdout.slice(0, newline));
+          if (result.ready) {
+            release();
+            resolve();
+          } else {
+            reject(new Error(result.error || 'Python helper failed to start'));
+          }
         } catch (e) {
           logger.error('kasa', 'Failed to parse Python output', { stdout, error: String(e) });
-          resolve({ error: `Failed to parse output: ${stdout}` });
+          reject(new Error(`Failed to parse output: ${stdout}`));
         }
       });
 
+      python.stderr.on('data', (data) => {
+        logger.debug('kasa', 'Python stderr', { stderr: data.toString() });
+      });
+
+      python.on('close', (code) => {
+        logger.debug('kasa', 'Python helper exited', { code });
+        reject(new Error(`Process exited with code ${code}`));
+      });
+
       python.on('error', (err) => {
         logger.error('kasa', 'Failed to spawn Python', { error: String(err) });
-        resolve({ error: `Failed to run Python: ${err.message}` });
+        reject(err);
       });
     });
   }
 
+  private attach(socket: net.Socket): void {
+    this.socket = socket;
+    this.buffer = Buffer.alloc(0);
+
+    socket.on('data', (data) => {
+      this.buffer = Buffer.concat([this.buffer, data]);
+      while (this.buffer.length >= 4) {
+        const length = this.buffer.readUInt32BE(0);
+        if (this.buffer.length < 4 + length) break;
+        const body = this.buffer.subarray(4, 4 + length).toString();
+        this.buffer = this.buffer.subarray(4 + length);
+        this.handleReply(body);
+      }
+    });
+
+    socket.on('error', (err) => {
+      logger.debug('kasa', 'Python helper socket error', { error: String(err) });
+    });
+
+    socket.on('close', () => {
+      if (this.socket === socket) this.socket = null;
+      this.failPending('Python helper connection closed');
+    });
+  }
+
+  private handleReply(body: string): void {
+    let reply: PythonResult & { id?: number | null; more?: boolean };
+    try {
+      reply = JSON.parse(body);
+    } catch (e) {
+      logger.error('kasa', 'Failed to parse Python output', { stdout: body, error: String(e) });
+      return;
+    }
+
+    const { id, more, ...result } = reply;
+    const entry = id != null ? this.pending.get(id) : undefined;
+    if (!entry) {
+      logger.error('kasa', 'Unmatched Python helper reply', { stdout: body });
+      return;
+    }
+    // Discover sends one frame per device as it is updated, then a final frame
+    if (more) {
+      entry.devices.push(...((result.devices ?? []) as KasaDevice[]));
+      return;
+    }
+    this.pending.delete(id as number);
+    if (entry.devices.length) {
+      result.devices = [...entry.devices, ...((result.devices ?? []) as KasaDevice[])];
+    }
+    // Per-device failures the helper hit while still producing a result
+    if (result.errors?.length) {
+      logger.warn('kasa', 'Python helper reported errors', { errors: result.errors });
+    }
+    entry.resolve(result);
+  }
+
+  private failPending(error: string): void {
+    const pending = [...this.pending.values()];
+    this.pending.clear();
+    for (const { resolve } of pending) {
+      resolve({ error });
+    }
+  }
+}
+
+// Helper clients keyed by credentials, since the server reads them from its environment
+const helperClients = new Map<string, KasaHelperClient>();
+
+// Private per-user directory holding the helper sockets and their naming salt
+function helperSocketDir(): string {
+  const uid = process.getuid ? process.getuid() : -1;
+  const dir = process.env.XDG_RUNTIME_DIR
+    ? path.join(process.env.XDG_RUNTIME_DIR, 'peek-kasa')
+    : path.join(os.tmpdir(), `peek-kasa-${uid}`);
+
+  try {
+    fs.mkdirSync(dir, { mode: 0o700 });
+  } catch (err) {
+    if ((err as NodeJS.ErrnoException).code !== 'EEXIST') throw err;
+  }
+
+  // A directory created or opened up by another user could hold a planted socket
+  const stat = fs.lstatSync(dir);
+  if (!stat.isDirectory() || (uid !== -1 && stat.uid !== uid) || (stat.mode & 0o077) !== 0) {
+    throw new Error(`Unsafe Kasa helper socket directory: ${dir}`);
+  }
+  return dir;
+}
+
+// Random per-install salt, so socket names reveal nothing about the credentials
+function helperSocketSalt(dir: string): Buffer {
+  const saltPath = path.join(dir, 'salt');
+  if (!fs.existsSync(saltPath)) {
+    // Write then link, so concurrent workers never read a partially written salt
+    const tmpPath = `${saltPath}.${process.pid}`;
+    fs.writeFileSync(tmpPath, randomBytes(32), { mode: 0o600 });
+    try {
+      fs.linkSync(tmpPath, saltPath);
+    } catch (err) {
+      if ((err as NodeJS.ErrnoException).code !== 'EEXIST') throw err;
+    } finally {
+      fs.unlinkSync(tmpPath);
+    }
+  }
+  return fs.readFileSync(saltPath);
+}
+
+// Socket path for a credential set
+function helperSocketPath(key: string): string {
+  const dir = helperSocketDir();
+  const name = createHmac('sha256', helperSocketSalt(dir)).update(key).digest('hex').slice(0, 24);
+  return path.join(dir, `${name}.sock`);
+}
+
+export class KasaIntegration extends BaseIntegration {
+  readonly type = 'kasa';
+  readonly name = 'TP-Link Kasa';
+
+  // Parse deviceIps from comma-separated string or array
+  private parseDeviceIps(config: KasaConfig): string[] {
+    const deviceIps = config.deviceIps;
+    if (!deviceIps) return [];
+    if (Array.isArray(deviceIps)) return deviceIps.filter((ip: string) => ip.trim());
+    if (typeof deviceIps === 'string') {
+      return deviceIps.split(',').map((ip: string) => ip.trim()).filter((ip: string) => ip);
+    }
+    return [];
+  }
+
+  // Run a command on the shared Python helper server for this config's credentials
+  private async runPythonHelper(args: string[], config?: KasaConfig): Promise<PythonResult> {
+    const email = config?.email || '';
+    const password = config?.password || '';
+    const key = `${email}\0${password}`;
+
+    let helper = helperClients.get(key);
+    if (!helper) {
+      let socketPath: string;
+      try {
+        socketPath = helperSocketPath(key);
+      } catch (err) {
+        logger.error('kasa', 'Failed to prepare Python helper socket', { error: String(err) });
+        return { error: `Failed to run Python: ${err instanceof Error ? err.message : String(err)}` };
+      }
+
+      // Pass credentials via environment variables
+      const env = { ...process.env };
+      if (email) {
+        env.KASA_EMAIL = email;
+      }
+      if (password) {
+        env.KASA_PASSWORD = password;
+      }
+      helper = new KasaHelperClient(socketPath, env);
+      helperClients.set(key, helper);
+    }
+
+    return helper.run(args);
+  }
+
   async testConnection(config: IntegrationConfig): Promise<ConnectionTestResult> {
     const kasaConfig = config as KasaConfig;
 
@@ -229,21 +448,8 @@ export class KasaIntegration extends BaseIntegration {
       const deviceIps = this.parseDeviceIps(config);
 
       if (deviceIps.length === 0) {
-        // First discover devices, then get energy for those with monitoring
-        const discoverResult = await this.runPythonHelper(['discover', '5'], config);
-        if (discoverResult.error || !discoverResult.devices) {
-          return { devices: [] };
-        }
-
-        const energyDeviceIps = (discoverResult.devices as KasaDevice[])
-          .filter(d => d.hasEnergyMonitoring)
-          .map(d => d.host);
-
-        if (energyDeviceIps.length === 0) {
-          return { devices: [] };
-        }
-
-        const result = await this.runPythonHelper(['get-all-energy', energyDeviceIps.join(',')], config);
+        // Discover devices and read energy for those with monitoring in one pass
+        const result = await this.runPythonHelper(['discover-energy', '5'], config);
         if (result.error) {
           logger.error('kasa', 'Failed to fetch energy usage', { error: result.error });
           return { devices: [] };
@@ -2,24 +2,67 @@
 """
 Kasa device helper script using python-kasa library.
 This provides KLAP protocol support for newer Kasa firmware.
-Called from Node.js backend via subprocess.
+Called from Node.js backend, either once per command via subprocess or as a
+long-lived Unix domain socket server with the "serve" command.
 """
 
+from __future__ import annotations
+
 import asyncio
+import contextlib
+import contextvars
+import fcntl
 import json
+import socket
 import sys
 import warnings
 import os
+from operator import attrgetter
+from typing import TYPE_CHECKING
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Suppress deprecation warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
-from kasa import Discover, Device, Credentials
+if TYPE_CHECKING:
+    from kasa import Device
 
 # Get credentials from environment variables (passed from Node.js)
 KASA_EMAIL = os.environ.get('KASA_EMAIL', '')
 KASA_PASSWORD = os.environ.get('KASA_PASSWORD', '')
 
+# Maximum number of devices queried concurrently in batch commands
+MAX_CONCURRENCY = 32
+
+# Seconds allowed for locating a single device; live devices answer in well under a second
+CONNECT_TIMEOUT = 3
+
+# Seconds allowed for each request to a connected device, e.g. a full power strip update
+REQUEST_TIMEOUT = 10
+
+# Seconds allowed for a whole batch command, shared by every IP in it
+BATCH_TIMEOUT = 15
+
+# Seconds a "serve" process stays up without requests before exiting
+IDLE_TIMEOUT = 600
+
+
+# python-kasa pulls in a large dependency tree, so it is imported
+# by load_kasa() on the first command that needs them rather than at startup
+Discover = None
+Credentials = None
+# EmeterStatus is not exported by every python-kasa release, so it may stay None
+EmeterStatus = None
+
 
 def get_credentials() -> Credentials | None:
     """Get credentials if available."""
@@ -28,155 +71,353 @@ def get_credentials() -> Credentials | None:
     return None
 
 
-async def discover_devices(timeout: int = 10) -> list[dict]:
-    """Discover Kasa devices on the network."""
-    devices = []
-    creds = get_credentials()
+# Credentials are fixed for the lifetime of the process, so build them once
+_CREDS: Credentials | None = None
+
+
+def load_kasa() -> None:
+    """Import python-kasa and build credentials."""
+    global Discover, Credentials, EmeterStatus, _CREDS
+    if Discover is not None:
+        return
+
+    import kasa
+
+    Discover, Credentials = kasa.Discover, kasa.Credentials
+    EmeterStatus = getattr(kasa, 'EmeterStatus', None)
+    _CREDS = get_credentials()
+
+
+# Connected devices by IP, reused across commands while the helper is serving
+_DEVICE_CACHE: dict[str, Device] = {}
+
+
+async def evict_device(ip: str) -> None:
+    """Drop a cached device and close its connection."""
+    device = _DEVICE_CACHE.pop(ip, None)
+    if device is not None:
+        with contextlib.suppress(Exception):
+            await device.disconnect()
+
+
+async def update_new_device(device: Device) -> None:
+    """Run a device's first update, closing its connection if the update fails or is cancelled."""
     try:
-        found = await Discover.discover(timeout=timeout, credentials=creds)
-        for ip, device in found.items():
-            try:
-                await device.update()
-                devices.append(device_to_dict(device))
-            except Exception as e:
-                print(f"Error updating device {ip}: {e}", file=sys.stderr)
+        await device.update()
+    except BaseException:
+        with contextlib.suppress(Exception):
+            await device.disconnect()
+        raise
+
+
+async def connect_device(ip: str) -> Device | None:
+    """Return an updated device for ip, reusing a cached connection when possible."""
+    device = _DEVICE_CACHE.get(ip)
+    if device is not None:
+        try:
+            await device.update()
+            return device
+        except Exception:
+            # Stale connection (e.g. expired KLAP session); rediscover below
+            await evict_device(ip)
+
+    try:
+        device = await asyncio.wait_for(
+            Discover.discover_single(ip, timeout=REQUEST_TIMEOUT, credentials=_CREDS),
+            timeout=CONNECT_TIMEOUT,
+        )
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"Timed out connecting to {ip}") from None
+    if not device:
+        return None
+    await update_new_device(device)
+    _DEVICE_CACHE[ip] = device
+    return device
+
+
+# Non-fatal errors for the serve-mode request being handled, returned as "errors"
+_ERRORS: contextvars.ContextVar[list[str] | None] = contextvars.ContextVar('errors', default=None)
+
+
+def log_error(message: str) -> None:
+    """Report a non-fatal error, such as one device failing in a batch.
+
+    In serve mode nothing reads stderr, so the message is added to the current
+    request's "errors" list instead.
+    """
+    errors = _ERRORS.get()
+    if errors is not None:
+        errors.append(message)
+    else:
+        print(message, file=sys.stderr)
+
+
+def encode(payload) -> bytes:
+    """Serialize a payload to JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload).encode()
+
+
+def emit(payload: dict) -> None:
+    """Write a JSON payload as a single line on stdout."""
+    sys.stdout.buffer.write(encode(payload) + b"\n")
+    sys.stdout.buffer.flush()
+
+
+async def update_discovered(ip: str, device: Device) -> dict | None:
+    """Update a discovered device, returning its dict or None on failure.
+
+    A device already cached for ip is reused, so its open connection is kept
+    rather than replaced by the freshly discovered one.
+    """
+    cached = _DEVICE_CACHE.get(ip)
+    if cached is not None and cached is not device:
+        try:
+            await cached.update()
+            return device_to_dict(cached)
+        except Exception:
+            # Stale connection; fall back to the freshly discovered device
+            await evict_device(ip)
+
+    try:
+        await update_new_device(device)
+        _DEVICE_CACHE[ip] = device
+        return device_to_dict(device)
     except Exception as e:
-        print(json.dumps({"error": str(e)}), file=sys.stderr)
-    return devices
+        # A broadcast may have cached this device before its first update
+        if _DEVICE_CACHE.get(ip) is device:
+            del _DEVICE_CACHE[ip]
+        log_error(f"Error updating device {ip}: {e}")
+        return None
+
+
+async def iter_discovered(timeout: int = 10):
+    """Discover Kasa devices on the network, yielding each dict as its update completes."""
+    try:
+        found = await Discover.discover(timeout=timeout, credentials=_CREDS)
+        tasks = [asyncio.ensure_future(update_discovered(ip, d)) for ip, d in found.items()]
+        try:
+            for update in asyncio.as_completed(tasks):
+                device = await update
+                if device is not None:
+                    yield device
+        finally:
+            # Stop outstanding updates if the consumer stops early or is cancelled
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    except Exception as e:
+        log_error(f"Error discovering devices: {e}")
+
+
+async def discover_devices(timeout: int = 10) -> list[dict]:
+    """Discover Kasa devices on the network."""
+    return [device async for device in iter_discovered(timeout)]
 
 
 async def get_device(ip: str) -> dict | None:
     """Get a single device by IP using the new API."""
-    creds = get_credentials()
     try:
-        # Use the new API: Discover.discover_single returns a connected device
-        device = await Discover.discover_single(ip, timeout=10, credentials=creds)
+        device = await connect_device(ip)
         if device:
-            await device.update()
             return device_to_dict(device)
     except Exception as e:
         return {"error": str(e), "ip": ip}
     return None
 
 
+async def gather_bounded(func, ips: list[str]) -> list:
+    """Run func(ip) for every IP concurrently, capped at MAX_CONCURRENCY.
+
+    All calls share one BATCH_TIMEOUT deadline, so offline IPs cannot stretch
+    the batch beyond it.
+    """
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + BATCH_TIMEOUT
+
+    async def _bounded(ip: str):
+        async with sem:
+            try:
+                return await asyncio.wait_for(func(ip), timeout=max(0.1, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                return {"error": "Timed out", "ip": ip}
+
+    return await asyncio.gather(*(_bounded(ip) for ip in ips), return_exceptions=True)
+
+
 async def get_devices(ips: list[str]) -> list[dict]:
     """Get multiple devices by IP."""
     devices = []
-    for ip in ips:
-        result = await get_device(ip)
+    results = await gather_bounded(get_device, ips)
+    for ip, result in zip(ips, results):
+        if isinstance(result, BaseException):
+            result = {"error": str(result), "ip": ip}
         if result and "error" not in result:
             devices.append(result)
         elif result and "error" in result:
-            print(f"Error for {ip}: {result['error']}", file=sys.stderr)
+            log_error(f"Error for {ip}: {result['error']}")
     return devices
 
 
+# Base type rules in priority order: (capability flag, DeviceType name fragment, base type).
+# A rule matches when its flag is set or the lowercased enum name contains the fragment.
+_TYPE_RULES = (
+    ("is_strip", "strip", "power_strip"),
+    ("is_bulb", "bulb", "bulb"),
+    ("is_plug", "plug", "plug"),
+    ("is_dimmer", "dimmer", "dimmer"),
+)
+
+# Bulb refinements, checked in order: (attr_name, device type)
+_BULB_TYPES = (
+    ("is_color", "bulb_color"),
+    ("is_variable_color_temp", "bulb_tunable"),
+    ("is_dimmable", "bulb_dimmable"),
+)
+
+
+# Device type by (model, DeviceType name). The capabilities that drive the
+# classification are fixed per model, so repeat polls skip the probes.
+_DEVICE_TYPE_CACHE: dict[tuple[str, str | None], str] = {}
+
+
+def classify_device(device: Device, type_name: str | None) -> str:
+    """Classify a device from its DeviceType name and capability flags."""
+    type_name = type_name or 'unknown'
+    for flag, fragment, base in _TYPE_RULES:
+        flagged = getattr(device, flag, False)
+        if not flagged and fragment not in type_name:
+            continue
+        # Bulbs are only refined when the capability flag confirms them
+        if base == "bulb" and flagged:
+            return next((t for attr, t in _BULB_TYPES if getattr(device, attr, False)), "bulb")
+        if base == "plug" and getattr(device, 'has_emeter', False):
+            return "plug_energy"
+        return base
+
+    # Unrecognised devices are reported as plain plugs
+    return "plug"
+
+
 def get_device_type(device: Device) -> str:
     """Determine the device type."""
-    device_type = device.device_type.name.lower() if hasattr(device, 'device_type') else 'unknown'
-
-    # Check for strip/power strip
-    if hasattr(device, 'is_strip') and device.is_strip:
-        return "power_strip"
-    if 'strip' in device_type:
-        return "power_strip"
-
-    # Check for bulb types
-    if hasattr(device, 'is_bulb') and device.is_bulb:
-        if hasattr(device, 'is_color') and device.is_color:
-            return "bulb_color"
-        if hasattr(device, 'is_variable_color_temp') and device.is_variable_color_temp:
-            return "bulb_tunable"
-        if hasattr(device, 'is_dimmable') and device.is_dimmable:
-            return "bulb_dimmable"
-        return "bulb"
-    if 'bulb' in device_type:
-        return "bulb"
-
-    # Check for plug types
-    if hasattr(device, 'is_plug') and device.is_plug:
-        if hasattr(device, 'has_emeter') and device.has_emeter:
-            return "plug_energy"
-        return "plug"
-    if 'plug' in device_type:
-        return "plug_energy" if (hasattr(device, 'has_emeter') and device.has_emeter) else "plug"
+    device_type = getattr(device, 'device_type', None)
+    type_name = device_type.name.lower() if device_type is not None else None
+    model = getattr(device, 'model', None)
+    if not model:
+        return classify_device(device, type_name)
+
+    key = (model, type_name)
+    result = _DEVICE_TYPE_CACHE.get(key)
+    if result is None:
+        result = _DEVICE_TYPE_CACHE[key] = classify_device(device, type_name)
+    return result
 
-    # Check for dimmer
-    if hasattr(device, 'is_dimmer') and device.is_dimmer:
-        return "dimmer"
-    if 'dimmer' in device_type:
-        return "dimmer"
 
-    return "plug"
+# Output shape of device_to_dict, in key order. The first seven keys are always
+# present; the rest are dropped when left as None.
+_DEVICE_KEYS = (
+    "deviceId", "alias", "deviceType", "model", "host", "isOn", "hasEnergyMonitoring",
+    "mac", "fwVersion", "hwVersion", "rssi", "ledOff",
+    "brightness", "colorTemp", "hue", "saturation", "children",
+)
+_REQUIRED_KEYS = frozenset(_DEVICE_KEYS[:7])
+
+# Fields always present in device_to_dict output: (json_key, attr_name, default)
+_FIELDS = (
+    ("alias", "alias", "Unknown"),
+    ("model", "model", "Unknown"),
+    ("isOn", "is_on", False),
+    ("hasEnergyMonitoring", "has_emeter", False),
+)
+
+# Fields only included when set: (json_key, attr_name, keep_falsy)
+_OPTIONAL_FIELDS = (
+    ("mac", "mac", False),
+    ("rssi", "rssi", True),
+    ("brightness", "brightness", True),
+    ("colorTemp", "color_temp", False),
+)
+
+
+# Child socket attributes read in one C-level call: (device_id, alias, is_on, host)
+_CHILD_ATTRS = attrgetter("device_id", "alias", "is_on", "host")
+
+
+def child_to_dict(child: Device) -> dict:
+    """Convert a child socket to a dictionary, tolerating missing attributes."""
+    return {
+        "id": getattr(child, 'device_id', None) or getattr(child, 'host', 'unknown'),
+        "alias": getattr(child, 'alias', 'Unknown'),
+        "isOn": getattr(child, 'is_on', False),
+    }
 
 
 def device_to_dict(device: Device) -> dict:
     """Convert device to dictionary for JSON serialization."""
-    result = {
-        "deviceId": getattr(device, 'device_id', None) or device.host,
-        "alias": getattr(device, 'alias', 'Unknown'),
-        "deviceType": get_device_type(device),
-        "model": getattr(device, 'model', 'Unknown'),
-        "host": device.host,
-        "isOn": getattr(device, 'is_on', False),
-        "hasEnergyMonitoring": getattr(device, 'has_emeter', False),
-    }
+    result = dict.fromkeys(_DEVICE_KEYS)
+    result["deviceId"] = getattr(device, 'device_id', None) or device.host
+    result["deviceType"] = get_device_type(device)
+    result["host"] = device.host
+    for key, attr, default in _FIELDS:
+        result[key] = getattr(device, attr, default)
 
     # Add optional fields safely
-    if hasattr(device, 'mac') and device.mac:
-        result["mac"] = device.mac
+    for key, attr, keep_falsy in _OPTIONAL_FIELDS:
+        value = getattr(device, attr, None)
+        if value is not None and (keep_falsy or value):
+            result[key] = value
 
     # Firmware and hardware versions
-    if hasattr(device, 'hw_info') and device.hw_info:
-        hw = device.hw_info
-        if isinstance(hw, dict):
-            if 'sw_ver' in hw:
-                result["fwVersion"] = hw['sw_ver']
-            if 'hw_ver' in hw:
-                result["hwVersion"] = hw['hw_ver']
-
-    # RSSI
-    if hasattr(device, 'rssi') and device.rssi is not None:
-        result["rssi"] = device.rssi
+    hw = getattr(device, 'hw_info', None)
+    if isinstance(hw, dict):
+        if 'sw_ver' in hw:
+            result["fwVersion"] = hw['sw_ver']
+        if 'hw_ver' in hw:
+            result["hwVersion"] = hw['hw_ver']
 
     # LED status
-    if hasattr(device, 'led') and device.led is not None:
-        result["ledOff"] = not device.led
-
-    # Bulb-specific properties
-    if hasattr(device, 'brightness') and device.brightness is not None:
-        result["brightness"] = device.brightness
-    if hasattr(device, 'color_temp') and device.color_temp:
-        result["colorTemp"] = device.color_temp
-    if hasattr(device, 'hsv') and device.hsv:
-        hsv = device.hsv
-        if hsv:
-            result["hue"] = hsv[0] if len(hsv) > 0 else None
-            result["saturation"] = hsv[1] if len(hsv) > 1 else None
+    led = getattr(device, 'led', None)
+    if led is not None:
+        result["ledOff"] = not led
+
+    # Bulb color
+    hsv = getattr(device, 'hsv', None)
+    if hsv:
+        result["hue"] = hsv[0] if len(hsv) > 0 else None
+        result["saturation"] = hsv[1] if len(hsv) > 1 else None
 
     # Power strip children
-    if hasattr(device, 'children') and device.children:
-        result["children"] = []
-        for child in device.children:
-            result["children"].append({
-                "id": getattr(child, 'device_id', child.host if hasattr(child, 'host') else 'unknown'),
-                "alias": getattr(child, 'alias', 'Unknown'),
-                "isOn": getattr(child, 'is_on', False),
-            })
+    children = getattr(device, 'children', None)
+    if children:
+        try:
+            result["children"] = [
+                {"id": device_id or host, "alias": alias, "isOn": is_on}
+                for device_id, alias, is_on, host in map(_CHILD_ATTRS, children)
+            ]
+        except AttributeError:
+            result["children"] = [child_to_dict(child) for child in children]
+
+    return {k: v for k, v in result.items() if v is not None or k in _REQUIRED_KEYS}
 
-    return result
+
+def realtime_value(realtime: dict, key: str, milli_key: str) -> float:
+    """Read a realtime emeter value, falling back to its milli-unit field."""
+    value = realtime.get(key)
+    if value is not None:
+        return value
+    return realtime.get(milli_key, 0) / 1000
 
 
 async def get_energy(ip: str) -> dict | None:
     """Get energy usage for a device."""
-    creds = get_credentials()
     try:
-        device = await Discover.discover_single(ip, timeout=10, credentials=creds)
+        device = await connect_device(ip)
         if not device:
             return None
 
-        await device.update()
-
         if not getattr(device, 'has_emeter', False):
             return None
 
@@ -192,21 +433,30 @@ async def get_energy(ip: str) -> dict | None:
         }
 
         # Get realtime energy data
-        if hasattr(device, 'emeter_realtime') and device.emeter_realtime:
-            realtime = device.emeter_realtime
-            # Handle both mW and W units
-            result["currentPower"] = realtime.get('power', realtime.get('power_mw', 0) / 1000 if 'power_mw' in realtime else 0)
-            result["voltage"] = realtime.get('voltage', realtime.get('voltage_mv', 0) / 1000 if 'voltage_mv' in realtime else 0)
-            result["current"] = realtime.get('current', realtime.get('current_ma', 0) / 1000 if 'current_ma' in realtime else 0)
-            result["totalEnergy"] = realtime.get('total', realtime.get('total_wh', 0) / 1000 if 'total_wh' in realtime else 0)
+        realtime = getattr(device, 'emeter_realtime', None)
+        if realtime:
+            if EmeterStatus is not None and isinstance(realtime, EmeterStatus):
+                # EmeterStatus converts mW/mV/mA/Wh to base units on item access
+                result["currentPower"] = realtime["power"] or 0
+                result["voltage"] = realtime["voltage"] or 0
+                result["current"] = realtime["current"] or 0
+                result["totalEnergy"] = realtime["total"] or 0
+            else:
+                # Plain dict: handle both mW and W units
+                result["currentPower"] = realtime_value(realtime, 'power', 'power_mw')
+                result["voltage"] = realtime_value(realtime, 'voltage', 'voltage_mv')
+                result["current"] = realtime_value(realtime, 'current', 'current_ma')
+                result["totalEnergy"] = realtime_value(realtime, 'total', 'total_wh')
 
         # Today's energy
-        if hasattr(device, 'emeter_today') and device.emeter_today is not None:
-            result["todayEnergy"] = device.emeter_today
+        today = getattr(device, 'emeter_today', None)
+        if today is not None:
+            result["todayEnergy"] = today
 
         # This month's energy
-        if hasattr(device, 'emeter_this_month') and device.emeter_this_month is not None:
-            result["monthEnergy"] = device.emeter_this_month
+        month = getattr(device, 'emeter_this_month', None)
+        if month is not None:
+            result["monthEnergy"] = month
 
         return result
     except Exception as e:
@@ -216,83 +466,282 @@ async def get_energy(ip: str) -> dict | None:
 async def get_all_energy(ips: list[str]) -> list[dict]:
     """Get energy usage for multiple devices."""
     results = []
-    for ip in ips:
-        result = await get_energy(ip)
+    for ip, result in zip(ips, await gather_bounded(get_energy, ips)):
+        if isinstance(result, BaseException):
+            result = {"error": str(result), "ip": ip}
         if result and "error" not in result:
             results.append(result)
+        elif result and "error" in result:
+            log_error(f"Error for {ip}: {result['error']}")
     return results
 
 
-async def main():
-    if len(sys.argv) < 2:
-        print(json.dumps({"error": "No command specified"}))
-        sys.exit(1)
+async def get_all_energy_broadcast(timeout: int = 5) -> list[dict]:
+    """Get energy usage for every device found by one broadcast discovery.
 
-    command = sys.argv[1]
+    Devices without energy monitoring are left out.
+    """
+    try:
+        found = await Discover.discover(timeout=timeout, credentials=_CREDS)
+    except Exception as e:
+        log_error(f"Error during broadcast discovery: {e}")
+        found = {}
+
+    for ip, device in found.items():
+        if ip not in _DEVICE_CACHE:
+            _DEVICE_CACHE[ip] = device
+
+    return await get_all_energy(list(found))
+
+
+class CommandError(Exception):
+    """Raised for an unknown command or missing arguments."""
+
+
+COMMANDS = frozenset({
+    "discover", "discover-energy", "get-device", "get-devices", "get-energy", "get-all-energy", "test",
+})
+
+
+def parse_ips(arg: str) -> list[str]:
+    """Split a comma-separated IP list."""
+    return [ip.strip() for ip in arg.split(",") if ip.strip()]
+
+
+async def dispatch(command: str, args: list[str]) -> dict:
+    """Run a single helper command and return its JSON payload."""
+    if command not in COMMANDS:
+        raise CommandError(f"Unknown command: {command}")
+    load_kasa()
+
+    if command == "discover":
+        timeout = int(args[0]) if args else 10
+        devices = await discover_devices(timeout)
+        return {"devices": devices}
+
+    if command == "get-device":
+        if not args:
+            raise CommandError("No IP specified")
+        device = await get_device(args[0])
+        return {"device": device}
+
+    if command == "get-devices":
+        if not args:
+            raise CommandError("No IPs specified")
+        devices = await get_devices(parse_ips(args[0]))
+        return {"devices": devices}
+
+    if command == "get-energy":
+        if not args:
+            raise CommandError("No IP specified")
+        energy = await get_energy(args[0])
+        return {"energy": energy}
 
+    if command == "get-all-energy":
+        if not args:
+            raise CommandError("No IPs specified")
+        energies = await get_all_energy(parse_ips(args[0]))
+        return {"devices": energies}
+
+    if command == "discover-energy":
+        timeout = int(args[0]) if args else 5
+        energies = await get_all_energy_broadcast(timeout=timeout)
+        return {"devices": energies}
+
+    if command == "test":
+        # Test connection - try to discover or connect to specific IPs
+        if args and args[0]:
+            devices = await get_devices(parse_ips(args[0]))
+            if devices:
+                return {"success": True, "devices": devices, "count": len(devices)}
+            return {"success": False, "error": "No devices found at specified IPs"}
+
+        timeout = int(args[1]) if len(args) > 1 else 10
+        devices = await discover_devices(timeout)
+        if devices:
+            return {"success": True, "devices": devices, "count": len(devices)}
+        return {"success": False, "error": "No devices discovered"}
+
+    raise CommandError(f"Unknown command: {command}")
+
+
+async def run_request(data: bytes):
+    """Run one serve-mode request, yielding its replies tagged with the request id.
+
+    "discover" yields a {"devices": [device], "more": true} reply per device as
+    its update completes; every request ends with a single reply without "more".
+    Errors logged while handling it are returned in that last reply's "errors" list.
+    """
+    request_id = None
+    errors: list[str] = []
+    _ERRORS.set(errors)
     try:
+        request = json.loads(data)
+        request_id = request.get("id")
+        command = request["command"]
+        args = [str(a) for a in request.get("args", [])]
         if command == "discover":
-            timeout = int(sys.argv[2]) if len(sys.argv) > 2 else 10
-            devices = await discover_devices(timeout)
-            print(json.dumps({"devices": devices}))
-
-        elif command == "get-device":
-            if len(sys.argv) < 3:
-                print(json.dumps({"error": "No IP specified"}))
-                sys.exit(1)
-            ip = sys.argv[2]
-            device = await get_device(ip)
-            print(json.dumps({"device": device}))
-
-        elif command == "get-devices":
-            if len(sys.argv) < 3:
-                print(json.dumps({"error": "No IPs specified"}))
-                sys.exit(1)
-            ips = [ip.strip() for ip in sys.argv[2].split(",") if ip.strip()]
-            devices = await get_devices(ips)
-            print(json.dumps({"devices": devices}))
-
-        elif command == "get-energy":
-            if len(sys.argv) < 3:
-                print(json.dumps({"error": "No IP specified"}))
-                sys.exit(1)
-            ip = sys.argv[2]
-            energy = await get_energy(ip)
-            print(json.dumps({"energy": energy}))
-
-        elif command == "get-all-energy":
-            if len(sys.argv) < 3:
-                print(json.dumps({"error": "No IPs specified"}))
-                sys.exit(1)
-            ips = [ip.strip() for ip in sys.argv[2].split(",") if ip.strip()]
-            energies = await get_all_energy(ips)
-            print(json.dumps({"devices": energies}))
-
-        elif command == "test":
-            # Test connection - try to discover or connect to specific IPs
-            if len(sys.argv) > 2 and sys.argv[2]:
-                ips = [ip.strip() for ip in sys.argv[2].split(",") if ip.strip()]
-                devices = await get_devices(ips)
-                if devices:
-                    print(json.dumps({"success": True, "devices": devices, "count": len(devices)}))
-                else:
-                    print(json.dumps({"success": False, "error": "No devices found at specified IPs"}))
-            else:
-                timeout = int(sys.argv[3]) if len(sys.argv) > 3 else 10
-                devices = await discover_devices(timeout)
-                if devices:
-                    print(json.dumps({"success": True, "devices": devices, "count": len(devices)}))
-                else:
-                    print(json.dumps({"success": False, "error": "No devices discovered"}))
-
+            load_kasa()
+            async for device in iter_discovered(int(args[0]) if args else 10):
+                yield {"id": request_id, "devices": [device], "more": True}
+            payload = {"devices": []}
         else:
-            print(json.dumps({"error": f"Unknown command: {command}"}))
+            payload = await dispatch(command, args)
+    except Exception as e:
+        payload = {"error": str(e)}
+    if errors:
+        payload["errors"] = errors
+    yield {"id": request_id, **payload}
+
+
+def frame(payload: dict) -> bytes:
+    """Encode a payload as a 4-byte big-endian length followed by its JSON body."""
+    body = encode(payload)
+    return len(body).to_bytes(4, "big") + body
+
+
+def socket_in_use(path: str) -> bool:
+    """Return True if a server is accepting connections on the Unix socket at path."""
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+        return True
+    except (FileNotFoundError, ConnectionRefusedError):
+        return False
+    finally:
+        probe.close()
+
+
+async def serve(path: str):
+    """Serve length-prefixed JSON requests on a Unix domain socket.
+
+    Each request is {"id": ..., "command": ..., "args": [...]}; replies carry
+    the same id, and the last reply for a request has no "more" key. Requests
+    run concurrently, so replies may arrive out of order.
+    Any number of clients may connect. The server exits after IDLE_TIMEOUT
+    seconds without requests.
+    """
+    loop = asyncio.get_running_loop()
+    last_activity = loop.time()
+    # Connection handler tasks, so idle shutdown can close clients that stay connected
+    clients: set[asyncio.Task] = set()
+
+    async def respond(writer: asyncio.StreamWriter, data: bytes) -> None:
+        nonlocal last_activity
+        async for reply in run_request(data):
+            last_activity = loop.time()
+            if not writer.is_closing():
+                writer.write(frame(reply))
+
+    async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        nonlocal last_activity
+        current = asyncio.current_task()
+        clients.add(current)
+        tasks = set()
+        try:
+            while True:
+                header = await reader.readexactly(4)
+                data = await reader.readexactly(int.from_bytes(header, "big"))
+                last_activity = loop.time()
+                task = asyncio.create_task(respond(writer, data))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # Idle shutdown; return normally so asyncio does not log the cancellation
+            for task in tasks:
+                task.cancel()
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+            with contextlib.suppress(Exception):
+                await writer.wait_closed()
+            clients.discard(current)
+
+    # Serialize startup with other servers spawned for the same path, so a live
+    # socket is never mistaken for a stale one and removed
+    lock_fd = os.open(path + ".lock", os.O_WRONLY | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        if socket_in_use(path):
+            # Another server won the race; the spawner connects to that one instead
+            emit({"ready": True})
+            return
+        # A socket file left behind by a previous server would make bind fail
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        server = await asyncio.start_unix_server(handle_client, path=path)
+        # The server answers with the stored credentials, so only this user may connect
+        os.chmod(path, 0o600)
+        inode = os.stat(path).st_ino
+    finally:
+        os.close(lock_fd)
+
+    # Tell the spawning process the socket is ready
+    emit({"ready": True})
+
+    # The server outlives the process that spawned it, so its pipes may close at
+    # any time. Send further output to devnull instead of failing on a broken pipe;
+    # diagnostics reach the client through each reply's "errors" list.
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.dup2(devnull, sys.stderr.fileno())
+    os.close(devnull)
+
+    try:
+        async with server:
+            while (idle := loop.time() - last_activity) < IDLE_TIMEOUT:
+                await asyncio.sleep(IDLE_TIMEOUT - idle)
+
+            # Leaving the block waits for open connections on Python 3.12+,
+            # so stop accepting and close the clients that are still connected
+            server.close()
+            for client in list(clients):
+                client.cancel()
+            await asyncio.gather(*clients, return_exceptions=True)
+    finally:
+        # Only remove the socket file if a newer server has not replaced it
+        with contextlib.suppress(OSError):
+            if os.stat(path).st_ino == inode:
+                os.unlink(path)
+
+
+async def run_command():
+    if len(sys.argv) < 2:
+        emit({"error": "No command specified"})
+        sys.exit(1)
+
+    command = sys.argv[1]
+
+    if command == "serve":
+        if len(sys.argv) < 3:
+            emit({"error": "No socket path specified"})
             sys.exit(1)
+        await serve(sys.argv[2])
+        return
 
+    try:
+        emit(await dispatch(command, sys.argv[2:]))
     except Exception as e:
-        print(json.dumps({"error": str(e)}))
+        emit({"error": str(e)})
         sys.exit(1)
 
 
+async def main():
+    try:
+        await run_command()
+    finally:
+        # Each cached device owns its transport session; close them before exit
+        for ip in list(_DEVICE_CACHE):
+            await evict_device(ip)
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    # uvloop is optional; it cuts per-socket overhead when many devices are queried at once
+    # uvloop.run() only exists from uvloop 0.18; older releases use the stdlib loop
+    if uvloop is not None and hasattr(uvloop, 'run'):
+        uvloop.run(main())
+    else:
+        asyncio.run(main())